@@ -1,144 +1,447 @@
 #!/usr/bin/env python3
 """
 Quick diagnostic script to check if mzML files contain MS2 data.
+
+By default only the start of each file is scanned: iteration stops once
+SAMPLE_LIMIT (or --sample-limit) MS2 spectra and 3 with a precursor m/z have
+been seen, so the summary counts describe that sample, not the whole file.
+Pass --full to scan every spectrum and report file totals.
+
+After a file has been scanned completely, the native ids and byte offsets of
+its MS2 spectra are cached under INDEX_CACHE_DIR (keyed by path, mtime and
+size). Later runs on the unchanged file read only those MS2 spectra by random
+access instead of parsing every MS1 scan. Pass --no-index-cache to disable.
 """
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import re
 import sys
+from functools import partial
+from itertools import islice
 from pathlib import Path
 
+from msplot_cache import msplot_cache_dir
+
 try:
     import pymzml
 except ImportError:
     print("Error: pymzml not installed. Install with: pip install pymzml")
     sys.exit(1)
 
-def check_ms2_in_file(mzml_path):
-    """Check if file has MS2 spectra and how to access precursor info."""
-    print(f"\n=== Checking {mzml_path.name} ===")
+try:
+    from tqdm import tqdm
+except ImportError:
+    # tqdm is optional: directory mode just runs without a progress bar
+    tqdm = None
+
+# Default number of MS2 spectra to look at before stopping (unless --full is given)
+SAMPLE_LIMIT = 50
+
+# Controlled-vocabulary (OBO) version used for every file. pymzml caches one
+# parsed translator per version and process, so pinning a single version lets
+# all files in a batch share it (the terms used here are stable across versions)
+OBO_VERSION = '4.1.79'
+
+# Where per-file MS2 index sidecars are kept between runs; bump the version
+# whenever the layout written by save_ms2_index changes
+INDEX_CACHE_DIR = msplot_cache_dir()
+INDEX_CACHE_VERSION = 2
+
+# Scan number inside a native id, the way pymzml reads it when keying an index
+SCAN_NUMBER_PATTERN = re.compile(r'(?:scan|scanId)=(\d+)')
+
+# Spectrum metadata keys that may hold the precursor m/z, in probe order
+PRECURSOR_KEYS = ('selected ion m/z', 'base peak m/z', 'precursor m/z')
+
+def iter_spectrum_keys(spectrum):
+    """
+    Lazily yield the metadata keys of a spectrum. Older pymzml spectra are
+    dict-like; pymzml 2.x has no keys(), so walk the cvParam names instead.
+    """
+    if hasattr(spectrum, 'keys'):
+        return iter(spectrum.keys())
+    return (param.get('name') for param in spectrum.element.iter()
+            if param.tag.endswith('cvParam'))
+
+def warm_obo_cache():
+    """
+    Parse the pinned OBO once in this process. Used before the worker pool is
+    created (forked workers inherit the parsed tables) and as the pool
+    initializer (spawned workers parse it once up front).
+    """
+    pymzml.obo.OboTranslator.from_cache(OBO_VERSION)['ms level']
+
+def index_cache_path(mzml_path):
+    """Return the sidecar path for a file's MS2 index (changes with mtime/size)."""
+    stat = mzml_path.stat()
+    key = f"{mzml_path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+    return INDEX_CACHE_DIR / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+def offset_key(offset_dict, native_id):
+    """
+    Return the key pymzml's offset_dict uses for the spectrum with this native
+    id, or None if it has none. Indexes read from an <indexList> are keyed by
+    the scan number as an int; indexes built by scanning use the id string.
+    """
+    if not isinstance(native_id, str):
+        return None
+    if native_id in offset_dict:
+        return native_id
+    match = SCAN_NUMBER_PATTERN.search(native_id) or re.search(r'(\d+)$', native_id)
+    if match and int(match.group(1)) in offset_dict:
+        return int(match.group(1))
+    return None
+
+def is_offset_key(key):
+    """True for the key types pymzml's offset_dict uses (int scan numbers or id strings)."""
+    return isinstance(key, str) or (isinstance(key, int) and not isinstance(key, bool))
+
+def load_ms2_index(mzml_path):
+    """
+    Load a cached MS2 index for mzml_path, or None if there is none.
+    A sidecar from another format version, or one that cannot be decoded
+    into the expected shape, counts as missing.
+    """
+    try:
+        with open(index_cache_path(mzml_path), encoding='utf-8') as f:
+            data = json.load(f)
+        if data['version'] != INDEX_CACHE_VERSION:
+            return None
+        ms2_entries = [(key, int(spectrum_idx), int(ms1_before))
+                       for key, spectrum_idx, ms1_before in data['ms2']]
+        # pymzml stores an offset either as an int or as a tuple (a list in JSON)
+        offsets = {key: tuple(int(o) for o in offset) if isinstance(offset, list) else int(offset)
+                   for key, offset in data['offsets']}
+        if not all(is_offset_key(key) and key in offsets for key, _, _ in ms2_entries):
+            return None
+        return {'ms1_count': int(data['ms1_count']), 'ms2': ms2_entries, 'offsets': offsets}
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+def save_ms2_index(mzml_path, run, ms1_count, ms2_entries):
+    """
+    Cache the MS2 spectra of a completely scanned file.
+    ms2_entries is a list of (native_id, spectrum_idx, ms1_before) tuples.
+    Offsets come from the file's own <indexList> when present; otherwise
+    the index is built once here. Spectra are stored under pymzml's own
+    offset keys; if any spectrum has no offset, nothing is cached.
+    """
+    offset_dict = run.info['offset_dict']
+    keys = [offset_key(offset_dict, native_id) for native_id, _, _ in ms2_entries]
+    if None in keys:
+        offset_dict = pymzml.run.Reader(str(mzml_path), obo_version=OBO_VERSION,
+                                        build_index_from_scratch=True,
+                                        skip_chromatogram=True).info['offset_dict']
+        keys = [offset_key(offset_dict, native_id) for native_id, _, _ in ms2_entries]
+        if None in keys:
+            return
+    index = {
+        'version': INDEX_CACHE_VERSION,
+        'ms1_count': ms1_count,
+        'ms2': [(key, spectrum_idx, ms1_before)
+                for key, (_, spectrum_idx, ms1_before) in zip(keys, ms2_entries)],
+        # A list of pairs, since JSON object keys would turn int keys into strings
+        'offsets': [(key, offset_dict[key]) for key in keys],
+    }
+    try:
+        INDEX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(index_cache_path(mzml_path), 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    except OSError:
+        pass
+
+def probe_precursor_mz(spectrum, precursor_keys=None, collect_info=True):
+    """
+    Try every known way of reading the precursor m/z from an MS2 spectrum.
+    Returns (precursor_mz, precursor_info, extractor) where extractor reads
+    the m/z again via the branch that succeeded (None if nothing worked).
+    precursor_keys is an optional per-file list of metadata keys; the key
+    that works is moved to the front so it is tried first next time.
+    precursor_info is only built (for reporting) when collect_info is set,
+    otherwise it is None.
+    """
+    precursor_mz = None
+    precursor_info = {} if collect_info else None
+    extractor = None
+    
+    # Method 1: Check precursors attribute
+    if hasattr(spectrum, 'precursors'):
+        if collect_info:
+            precursor_info['has_precursors_attr'] = True
+        try:
+            prec_list = spectrum.precursors
+            if prec_list:
+                if collect_info:
+                    precursor_info['precursors_len'] = len(prec_list)
+                    precursor_info['precursors_type'] = type(prec_list[0]).__name__ if prec_list else None
+                if prec_list and len(prec_list) > 0:
+                    p = prec_list[0]
+                    if isinstance(p, dict):
+                        precursor_mz = p.get('mz', None)
+                        if collect_info:
+                            precursor_info['precursor_mz_from_dict'] = precursor_mz
+                        extractor = lambda s: s.precursors[0].get('mz', None)
+                    elif hasattr(p, 'mz'):
+                        precursor_mz = p.mz
+                        if collect_info:
+                            precursor_info['precursor_mz_from_attr'] = precursor_mz
+                        extractor = lambda s: s.precursors[0].mz
+        except Exception as e:
+            if collect_info:
+                precursor_info['precursors_error'] = str(e)
+    elif collect_info:
+        precursor_info['has_precursors_attr'] = False
+    
+    # Method 2: Check selected_precursors
+    if precursor_mz is None and hasattr(spectrum, 'selected_precursors'):
+        try:
+            selected = spectrum.selected_precursors
+            if selected:
+                if collect_info:
+                    precursor_info['has_selected_precursors'] = True
+                if isinstance(selected[0], dict):
+                    precursor_mz = selected[0].get('mz', None)
+                    extractor = lambda s: s.selected_precursors[0].get('mz', None)
+                elif hasattr(selected[0], 'mz'):
+                    precursor_mz = selected[0].mz
+                    extractor = lambda s: s.selected_precursors[0].mz
+        except Exception as e:
+            pass
+    
+    # Method 3: Dictionary access
+    if precursor_mz is None:
+        for key in (precursor_keys if precursor_keys is not None else PRECURSOR_KEYS):
+            val = spectrum.get(key, None)
+            if val:
+                try:
+                    precursor_mz = float(val)
+                    if collect_info:
+                        precursor_info[f'precursor_from_{key}'] = precursor_mz
+                    extractor = lambda s, key=key: float(s.get(key))
+                    if precursor_keys is not None and precursor_keys[0] != key:
+                        precursor_keys.remove(key)
+                        precursor_keys.insert(0, key)
+                    break
+                except (ValueError, TypeError):
+                    pass
+    
+    if not precursor_mz:
+        extractor = None
+    return precursor_mz, precursor_info, extractor
+
+def check_ms2_in_file(mzml_path, full_scan=False, use_index_cache=True,
+                      sample_limit=SAMPLE_LIMIT):
+    """
+    Check if file has MS2 spectra and how to access precursor info.
+    Returns a result dict; nothing is printed here so that files can be
+    checked in worker processes and reported in order by the caller.
+    Unless full_scan is set, stops after a sample of sample_limit MS2 spectra.
+    With use_index_cache, a cached MS2 index is used (and written) if possible.
+    """
+    result = {
+        'name': mzml_path.name,
+        'truncated': False,
+        'spectra_scanned': 0,
+        'ms1_count': 0,
+        'ms2_count': 0,
+        'ms2_with_precursor': 0,
+        'ms2_details': [],
+        'ms2_precursor_examples': [],
+        'error': None,
+    }
     
     try:
-        run = pymzml.run.Reader(str(mzml_path))
+        run = pymzml.run.Reader(str(mzml_path), obo_version=OBO_VERSION,
+                                build_index_from_scratch=False,
+                                skip_chromatogram=True)
         ms1_count = 0
         ms2_count = 0
         ms2_with_precursor = 0
-        ms2_precursor_examples = []
+        ms2_precursor_examples = result['ms2_precursor_examples']
+        extractor = None
+        precursor_keys = list(PRECURSOR_KEYS)
+        
+        index = load_ms2_index(mzml_path) if use_index_cache else None
+        if index is not None:
+            # Jump straight to the MS2 spectra; MS1 counts come from the index
+            run.info['offset_dict'].update(index['offsets'])
+            spectra = ((spectrum_idx, run[key])
+                       for key, spectrum_idx, _ in index['ms2'])
+        else:
+            spectra = enumerate(run)
+        ms2_entries = []
         
-        for i, spectrum in enumerate(run):
-            ms_level = spectrum.get('ms level', 0)
+        for i, spectrum in spectra:
+            # pymzml 2.x parses the ms level once into a property; older
+            # releases only offer the dict-style (cvParam scanning) lookup
+            try:
+                ms_level = spectrum.ms_level
+            except AttributeError:
+                ms_level = spectrum.get('ms level', 0)
             
+            # MS1 scans are only counted: skip them before any peak decoding
             if ms_level == 1:
                 ms1_count += 1
-            elif ms_level == 2:
-                ms2_count += 1
-                
-                # Try to extract precursor info
-                precursor_mz = None
-                precursor_info = {}
-                
-                # Method 1: Check precursors attribute
-                if hasattr(spectrum, 'precursors'):
-                    precursor_info['has_precursors_attr'] = True
-                    try:
-                        prec_list = spectrum.precursors
-                        if prec_list:
-                            precursor_info['precursors_len'] = len(prec_list)
-                            precursor_info['precursors_type'] = type(prec_list[0]).__name__ if prec_list else None
-                            if prec_list and len(prec_list) > 0:
-                                p = prec_list[0]
-                                if isinstance(p, dict):
-                                    precursor_mz = p.get('mz', None)
-                                    precursor_info['precursor_mz_from_dict'] = precursor_mz
-                                elif hasattr(p, 'mz'):
-                                    precursor_mz = p.mz
-                                    precursor_info['precursor_mz_from_attr'] = precursor_mz
-                    except Exception as e:
-                        precursor_info['precursors_error'] = str(e)
-                else:
-                    precursor_info['has_precursors_attr'] = False
-                
-                # Method 2: Check selected_precursors
-                if precursor_mz is None and hasattr(spectrum, 'selected_precursors'):
-                    try:
-                        selected = spectrum.selected_precursors
-                        if selected:
-                            precursor_info['has_selected_precursors'] = True
-                            if isinstance(selected[0], dict):
-                                precursor_mz = selected[0].get('mz', None)
-                            elif hasattr(selected[0], 'mz'):
-                                precursor_mz = selected[0].mz
-                    except Exception as e:
-                        pass
-                
-                # Method 3: Dictionary access
+                continue
+            if ms_level != 2:
+                continue
+            
+            ms2_count += 1
+            if index is None:
+                ms2_entries.append((spectrum.element.get('id'), i, ms1_count))
+            
+            # The full probe cascade is only needed while details/examples are
+            # still being collected; afterwards reuse the branch that worked
+            if extractor is not None and ms2_count > 3 and len(ms2_precursor_examples) >= 3:
+                precursor_info = None
+                try:
+                    precursor_mz = extractor(spectrum)
+                except Exception:
+                    precursor_mz = None
                 if precursor_mz is None:
-                    for key in ['selected ion m/z', 'base peak m/z', 'precursor m/z']:
-                        val = spectrum.get(key, None)
-                        if val:
-                            try:
-                                precursor_mz = float(val)
-                                precursor_info[f'precursor_from_{key}'] = precursor_mz
-                                break
-                            except (ValueError, TypeError):
-                                pass
-                
-                if precursor_mz:
-                    ms2_with_precursor += 1
-                    if len(ms2_precursor_examples) < 3:
-                        ms2_precursor_examples.append({
-                            'spectrum_idx': i,
-                            'precursor_mz': precursor_mz,
-                            'method': list(precursor_info.keys())[-1] if precursor_info else 'unknown',
-                            'peaks_count': len(spectrum.peaks('raw')) if spectrum.peaks('raw') else 0
-                        })
-                
-                # Print details for first few MS2 spectra
-                if ms2_count <= 3:
-                    print(f"  MS2 spectrum #{ms2_count}:")
-                    print(f"    Index: {i}")
-                    print(f"    Precursor info: {precursor_info}")
-                    if precursor_mz:
-                        print(f"    ✓ Precursor m/z: {precursor_mz:.4f}")
-                        peaks = spectrum.peaks('raw')
-                        if peaks:
-                            print(f"    Peaks: {len(peaks)}")
-                    else:
-                        print(f"    ✗ No precursor m/z found")
-                    
+                    precursor_mz, _, _ = probe_precursor_mz(spectrum, precursor_keys,
+                                                            collect_info=False)
+            else:
+                # precursor_info is only reported for the sampled spectra
+                precursor_mz, precursor_info, found = probe_precursor_mz(
+                    spectrum, precursor_keys,
+                    collect_info=ms2_count <= 3 or len(ms2_precursor_examples) < 3)
+                if found is not None:
+                    extractor = found
+            
+            # Decode peaks at most once, and only for spectra that are reported
+            peaks_count = None
+            if precursor_mz and (ms2_count <= 3 or len(ms2_precursor_examples) < 3):
+                peaks = spectrum.peaks('raw')
+                peaks_count = len(peaks) if peaks is not None else 0
+            
+            if precursor_mz:
+                ms2_with_precursor += 1
+                if len(ms2_precursor_examples) < 3:
+                    ms2_precursor_examples.append({
+                        'spectrum_idx': i,
+                        'precursor_mz': precursor_mz,
+                        'method': list(precursor_info.keys())[-1] if precursor_info else 'unknown',
+                        'peaks_count': peaks_count
+                    })
+            
+            # Keep details for first few MS2 spectra
+            if ms2_count <= 3:
+                result['ms2_details'].append({
+                    'ms2_num': ms2_count,
+                    'spectrum_idx': i,
+                    'precursor_info': precursor_info,
+                    'precursor_mz': precursor_mz,
+                    'peaks_count': peaks_count,
                     # Show all available keys
-                    print(f"    Available keys: {list(spectrum.keys())[:10]}...")
-        
-        print(f"\nSummary:")
-        print(f"  MS1 spectra: {ms1_count}")
-        print(f"  MS2 spectra: {ms2_count}")
-        print(f"  MS2 with precursor: {ms2_with_precursor}")
+                    'keys': list(islice(iter_spectrum_keys(spectrum), 10)),
+                })
+            
+            if not full_scan and ms2_count >= sample_limit and ms2_with_precursor >= 3:
+                result['truncated'] = True
+                result['spectra_scanned'] = i + 1
+                break
         
-        if ms2_precursor_examples:
-            print(f"\nExample MS2 precursors found:")
-            for ex in ms2_precursor_examples:
-                print(f"  Spectrum {ex['spectrum_idx']}: m/z={ex['precursor_mz']:.4f} "
-                      f"(via {ex['method']}), {ex['peaks_count']} peaks")
+        if index is not None:
+            if result['truncated']:
+                ms1_count = index['ms2'][ms2_count - 1][2]
+            else:
+                ms1_count = index['ms1_count']
+        elif use_index_cache and not result['truncated']:
+            save_ms2_index(mzml_path, run, ms1_count, ms2_entries)
         
-        return ms2_count > 0, ms2_with_precursor > 0
+        result['ms1_count'] = ms1_count
+        result['ms2_count'] = ms2_count
+        result['ms2_with_precursor'] = ms2_with_precursor
         
     except Exception as e:
-        print(f"  Error: {e}")
         import traceback
-        traceback.print_exc()
+        result['error'] = str(e)
+        result['traceback'] = traceback.format_exc()
+    
+    return result
+
+
+def print_report(result):
+    """Print the diagnostic report for one check_ms2_in_file() result."""
+    print(f"\n=== Checking {result['name']} ===")
+    
+    for detail in result['ms2_details']:
+        print(f"  MS2 spectrum #{detail['ms2_num']}:")
+        print(f"    Index: {detail['spectrum_idx']}")
+        print(f"    Precursor info: {detail['precursor_info']}")
+        if detail['precursor_mz']:
+            print(f"    ✓ Precursor m/z: {detail['precursor_mz']:.4f}")
+            if detail['peaks_count']:
+                print(f"    Peaks: {detail['peaks_count']}")
+        else:
+            print(f"    ✗ No precursor m/z found")
+        print(f"    Available keys: {detail['keys']}...")
+    
+    if result['error'] is not None:
+        print(f"  Error: {result['error']}")
+        print(result['traceback'], end='', file=sys.stderr)
         return False, False
+    
+    if result['truncated']:
+        print(f"\nSummary (sample of first {result['spectra_scanned']} spectra scanned, use --full for file totals):")
+    else:
+        print(f"\nSummary:")
+    print(f"  MS1 spectra: {result['ms1_count']}")
+    print(f"  MS2 spectra: {result['ms2_count']}")
+    print(f"  MS2 with precursor: {result['ms2_with_precursor']}")
+    
+    if result['ms2_precursor_examples']:
+        print(f"\nExample MS2 precursors found:")
+        for ex in result['ms2_precursor_examples']:
+            print(f"  Spectrum {ex['spectrum_idx']}: m/z={ex['precursor_mz']:.4f} "
+                  f"(via {ex['method']}), {ex['peaks_count']} peaks")
+    
+    return result['ms2_count'] > 0, result['ms2_with_precursor'] > 0
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: python3 check_mzml_ms2.py <mzml_file_or_dir>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description='Check if mzML files contain MS2 data and precursor info'
+    )
+    parser.add_argument('input_path', help='mzML file or directory containing mzML files')
+    parser.add_argument('--full', action='store_true',
+                       help='Scan every spectrum instead of stopping after --sample-limit MS2 spectra')
+    parser.add_argument('--sample-limit', type=int, default=SAMPLE_LIMIT,
+                       help=f'Number of MS2 spectra to sample per file (default: {SAMPLE_LIMIT})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                       help='Number of worker processes in directory mode (default: CPU count)')
+    parser.add_argument('--no-index-cache', action='store_true',
+                       help=f'Do not read or write cached MS2 indexes in {INDEX_CACHE_DIR}')
+    args = parser.parse_args()
     
-    input_path = Path(sys.argv[1])
+    input_path = Path(args.input_path)
+    check_file = partial(check_ms2_in_file, full_scan=args.full,
+                         use_index_cache=not args.no_index_cache,
+                         sample_limit=args.sample_limit)
     
     if input_path.is_file():
-        check_ms2_in_file(input_path)
+        print_report(check_file(input_path))
     elif input_path.is_dir():
-        mzml_files = list(input_path.glob("*.mzML")) + list(input_path.glob("*.mzml"))
-        for mzml_file in sorted(mzml_files):
-            check_ms2_in_file(mzml_file)
+        mzml_files = sorted(list(input_path.glob("*.mzML")) + list(input_path.glob("*.mzml")))
+        # Files are independent, so parse them in parallel; imap hands results
+        # back in file order as soon as each one (and those before it) is done,
+        # so reports stream deterministically and printing stays on the main process
+        workers = max(1, args.workers)
+        chunksize = max(1, len(mzml_files) // (4 * workers))
+        warm_obo_cache()
+        with mp.Pool(workers, initializer=warm_obo_cache) as pool:
+            results = pool.imap(check_file, mzml_files, chunksize=chunksize)
+            if tqdm is not None:
+                results = tqdm(results, total=len(mzml_files), unit='file', file=sys.stderr)
+            for result in results:
+                if tqdm is not None:
+                    with tqdm.external_write_mode():
+                        print_report(result)
+                else:
+                    print_report(result)
     else:
         print(f"Error: {input_path} is not a file or directory")
         sys.exit(1)
-
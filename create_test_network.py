@@ -17,16 +17,21 @@ Usage:
 
 import sys
 import os
+import io
 import argparse
+import hashlib
+import multiprocessing as mp
+from bisect import bisect_left, bisect_right
+from contextlib import nullcontext, redirect_stderr, redirect_stdout
+from itertools import compress
 from pathlib import Path
 import numpy as np
 from collections import defaultdict
 import math
 import zipfile
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
 from datetime import datetime
-import tempfile
+
+from msplot_cache import msplot_cache_dir
 
 try:
     import pymzml
@@ -47,76 +52,272 @@ except ImportError:
     print("Error: scipy not installed. Install with: pip install scipy")
     sys.exit(1)
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional: without it the kernels below run as plain Python
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
 
-def cosine_similarity_ms2(spectrum1, spectrum2, mz_tolerance=0.02):
+try:
+    import simsimd
+except ImportError:
+    # simsimd is optional: the binned similarity falls back to a NumPy matrix product
+    simsimd = None
+
+# cysession.xml of the exported .cys archive (a single network)
+CYSESSION_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<CySession xmlns="http://www.cytoscape.org" appName="Cytoscape" version="3.10.4">
+  <networks>
+    <network name="MS2 Molecular Network" id="1" file="networks/network1.xgmml"/>
+  </networks>
+</CySession>
+"""
+
+# m/z tolerance for pairing fragment peaks when comparing MS2 spectra (Da)
+MS2_MZ_TOLERANCE = 0.02
+
+# A sample feature matches a blank feature within these m/z (Da) and RT (min) windows
+BLANK_MZ_TOLERANCE = 0.01
+BLANK_RT_TOLERANCE = 0.1
+
+# Parsed features are cached per mzML file here; bump the version whenever
+# extract_features_from_mzml changes what it returns
+FEATURE_CACHE_DIR = msplot_cache_dir()
+FEATURE_CACHE_VERSION = 2
+
+
+@njit(fastmath=True, cache=True)
+def _matched_dot(mz1, int1, mz2, int2, tol):
     """
-    Compute cosine similarity between two MS2 spectra.
-    Spectra are lists of (mz, intensity) tuples.
+    Dot product of matched intensities of two m/z-sorted spectra (two-pointer merge).
+    Peaks within tol are paired in order; unmatched peaks contribute nothing.
     """
-    if not spectrum1 or not spectrum2:
-        return 0.0
-    
-    # Align spectra by m/z (within tolerance)
-    aligned1 = []
-    aligned2 = []
-    
-    i, j = 0, 0
-    while i < len(spectrum1) and j < len(spectrum2):
-        mz1, int1 = spectrum1[i]
-        mz2, int2 = spectrum2[j]
-        
-        if abs(mz1 - mz2) <= mz_tolerance:
-            # Match found - use average m/z
-            avg_mz = (mz1 + mz2) / 2
-            aligned1.append((avg_mz, int1))
-            aligned2.append((avg_mz, int2))
+    dot = 0.0
+    i = 0
+    j = 0
+    while i < len(mz1) and j < len(mz2):
+        if abs(mz1[i] - mz2[j]) <= tol:
+            dot += int1[i] * int2[j]
             i += 1
             j += 1
-        elif mz1 < mz2:
-            aligned1.append((mz1, int1))
-            aligned2.append((mz1, 0.0))
+        elif mz1[i] < mz2[j]:
             i += 1
         else:
-            aligned1.append((mz2, 0.0))
-            aligned2.append((mz2, int2))
             j += 1
-    
-    # Add remaining peaks
-    while i < len(spectrum1):
-        aligned1.append(spectrum1[i])
-        aligned2.append((spectrum1[i][0], 0.0))
-        i += 1
-    while j < len(spectrum2):
-        aligned1.append((spectrum2[j][0], 0.0))
-        aligned2.append(spectrum2[j])
-        j += 1
-    
-    # Extract intensity vectors
-    int1 = np.array([x[1] for x in aligned1])
-    int2 = np.array([x[1] for x in aligned2])
-    
-    # Compute cosine similarity
-    dot_product = np.dot(int1, int2)
-    norm1 = np.linalg.norm(int1)
-    norm2 = np.linalg.norm(int2)
-    
-    if norm1 == 0 or norm2 == 0:
+    return dot
+
+
+@njit(cache=True)
+def _segment_cumsum_sq(int_flat, offsets):
+    """
+    Running sum of squared intensities, restarted at the start of every packed spectrum.
+    """
+    out = np.empty(len(int_flat))
+    for k in range(len(offsets) - 1):
+        total = 0.0
+        for p in range(offsets[k], offsets[k + 1]):
+            total += int_flat[p] * int_flat[p]
+            out[p] = total
+    return out
+
+
+@njit(cache=True)
+def _range_sum_sq(cum_sq, start, lo, hi):
+    """Sum of squared intensities for packed positions lo..hi-1 of the spectrum starting at start."""
+    if hi <= lo:
         return 0.0
+    total = cum_sq[hi - 1]
+    if lo > start:
+        total -= cum_sq[lo - 1]
+    return total
+
+
+@njit(cache=True)
+def _similarity_row(i, out, mz_flat, int_flat, offsets, cum_sq, tol, min_score):
+    """
+    Fill out[i, i + 1:] with the cosine of spectrum i against every later spectrum.
+    Intensities are unit-normalized, so the matched dot product is the cosine.
+    Pairs whose upper bound is below min_score are left at 0 without merging.
+    """
+    n = len(offsets) - 1
+    a = offsets[i]
+    b = offsets[i + 1]
+    if _range_sum_sq(cum_sq, a, a, b) == 0.0:
+        return
+    for j in range(i + 1, n):
+        c = offsets[j]
+        d = offsets[j + 1]
+        if _range_sum_sq(cum_sq, c, c, d) == 0.0:
+            continue
+        
+        # Only peaks inside the other spectrum's m/z range (+ tol) can match, so by
+        # Cauchy-Schwarz the cosine is at most sqrt(overlap_i * overlap_j)
+        if min_score > 0.0:
+            lo_i = a + np.searchsorted(mz_flat[a:b], mz_flat[c] - tol)
+            hi_i = a + np.searchsorted(mz_flat[a:b], mz_flat[d - 1] + tol, side='right')
+            lo_j = c + np.searchsorted(mz_flat[c:d], mz_flat[a] - tol)
+            hi_j = c + np.searchsorted(mz_flat[c:d], mz_flat[b - 1] + tol, side='right')
+            bound_sq = (_range_sum_sq(cum_sq, a, lo_i, hi_i)
+                        * _range_sum_sq(cum_sq, c, lo_j, hi_j))
+            # Small slack so rounding never prunes a pair sitting exactly on the threshold
+            limit = min_score * (1.0 - 1e-9)
+            if bound_sq < limit * limit:
+                continue
+        
+        out[i, j] = _matched_dot(mz_flat[a:b], int_flat[a:b], mz_flat[c:d], int_flat[c:d], tol)
+
+
+@njit(parallel=True, cache=True)
+def _similarity_edges(mz_flat, int_flat, offsets, tol, min_score):
+    """
+    Cosine of every pair of spectra packed end to end (see pack_spectra), returned
+    as (i_idx, j_idx, score) arrays for the pairs i < j scoring at least min_score,
+    in row-major order. Pairs whose upper bound is below min_score are never merged.
+    """
+    n = len(offsets) - 1
+    scores = np.zeros((n, n))
+    cum_sq = _segment_cumsum_sq(int_flat, offsets)
+    # Row i of the upper triangle has n - 1 - i pairs, so rows are handed out in
+    # pairs (k, n - 1 - k) to give every parallel iteration the same amount of work.
+    # Each row is only written by the iteration that owns it.
+    for k in prange((n + 1) // 2):
+        _similarity_row(k, scores, mz_flat, int_flat, offsets, cum_sq, tol, min_score)
+        if n - 1 - k != k:
+            _similarity_row(n - 1 - k, scores, mz_flat, int_flat, offsets, cum_sq, tol, min_score)
+    
+    count = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            if scores[i, j] >= min_score:
+                count += 1
+    i_idx = np.empty(count, dtype=np.int64)
+    j_idx = np.empty(count, dtype=np.int64)
+    edge_scores = np.empty(count)
+    count = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            if scores[i, j] >= min_score:
+                i_idx[count] = i
+                j_idx[count] = j
+                edge_scores[count] = scores[i, j]
+                count += 1
+    return i_idx, j_idx, edge_scores
+
+
+def warm_up_similarity_kernels():
+    """
+    Run the similarity kernels once on a tiny input so numba compiles them (or
+    loads them from its cache) before the real spectra are ready.
+    """
+    mz_flat, int_flat, offsets = pack_spectra([(np.array([100.0, 200.0]), np.array([1.0, 2.0]))] * 2)
+    _similarity_edges(mz_flat, int_flat, offsets, MS2_MZ_TOLERANCE, 0.5)
+
+
+def binned_similarity_matrix(mz_flat, int_flat, offsets, bin_width=MS2_MZ_TOLERANCE):
+    """
+    Approximate cosine matrix from spectra binned onto a shared m/z grid.
+    Rows are L2-normalized so a single matrix product gives every pairwise score.
+    Peaks only match when they fall in the same bin of width bin_width.
+    """
+    n = len(offsets) - 1
+    # Bins are fixed multiples of bin_width, so a pair's score does not depend on
+    # which other spectra are being compared; only the occupied range is allocated
+    bins = np.floor(mz_flat / bin_width).astype(np.int64)
+    first_bin = bins.min()
+    num_bins = int(bins.max() - first_bin) + 1
     
-    return dot_product / (norm1 * norm2)
+    vectors = np.zeros((n, num_bins), dtype=np.float32)
+    rows = np.repeat(np.arange(n), np.diff(offsets))
+    np.add.at(vectors, (rows, bins - first_bin), int_flat)
+    
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    empty = norms[:, 0] == 0
+    norms[empty] = 1.0
+    vectors /= norms
+    
+    if simsimd is not None:
+        # SIMD kernels, without BLAS thread start-up cost for small matrices
+        similarity_matrix = 1.0 - np.asarray(simsimd.cdist(vectors, vectors, metric='cosine'),
+                                             dtype=np.float64)
+        # simsimd scores a pair of empty spectra as identical
+        similarity_matrix[empty, :] = 0.0
+        similarity_matrix[:, empty] = 0.0
+    else:
+        similarity_matrix = (vectors @ vectors.T).astype(np.float64)
+    np.fill_diagonal(similarity_matrix, 0.0)
+    return similarity_matrix
+
+
+def pack_spectra(spectra):
+    """
+    Prepare (mz, intensity) spectra for the similarity kernels, once per spectrum.
+    Returns float64 mz_flat/int_flat with spectrum k at [offsets[k]:offsets[k + 1]].
+    Each spectrum's intensities are scaled to unit norm (scores are always computed
+    in float64, whatever precision the spectra are stored in).
+    """
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(mzs) for mzs, _ in spectra])
+    mz_flat = np.concatenate([mzs for mzs, _ in spectra]).astype(np.float64, copy=False)
+    int_flat = np.concatenate([intensities for _, intensities in spectra]).astype(np.float64)
+    norms = np.array([np.linalg.norm(int_flat[offsets[k]:offsets[k + 1]])
+                      for k in range(len(spectra))])
+    # Spectra without intensity keep their zeros
+    norms[norms == 0] = 1.0
+    int_flat /= np.repeat(norms, np.diff(offsets))
+    return mz_flat, int_flat, offsets
+
+
+def add_sorted_feature(sorted_mzs, sorted_entries, mz, fid):
+    """
+    Insert a feature into the m/z-sorted lookup lists used by closest_feature.
+    Features with equal m/z stay in the order they were added.
+    """
+    pos = bisect_right(sorted_mzs, mz)
+    sorted_mzs.insert(pos, mz)
+    sorted_entries.insert(pos, (len(sorted_entries), fid))
+
+
+def closest_feature(sorted_mzs, sorted_entries, target_mz, tolerance):
+    """
+    Return the fid whose m/z is closest to target_mz (difference < tolerance), or None.
+    On equal differences the feature that was added first wins.
+    """
+    k = bisect_left(sorted_mzs, target_mz)
+    candidates = []
+    if k > 0:
+        # First (earliest added) feature of the nearest m/z value below target_mz
+        candidates.append(bisect_left(sorted_mzs, sorted_mzs[k - 1]))
+    if k < len(sorted_mzs):
+        candidates.append(k)
+    
+    best = None
+    best_key = None
+    for pos in candidates:
+        diff = abs(sorted_mzs[pos] - target_mz)
+        if diff < tolerance and (best_key is None or (diff, sorted_entries[pos][0]) < best_key):
+            best = sorted_entries[pos][1]
+            best_key = (diff, sorted_entries[pos][0])
+    return best
 
 
 def extract_features_from_mzml(mzml_path, is_blank=False):
     """
     Extract MS1 features and MS2 spectra from mzML file.
-    Returns: (features_dict, ms2_spectra_dict)
+    Returns: (features_dict, ms2_spectra_dict, ok); ok is False when reading the
+    file failed part way, in which case the dicts hold what was read before the error
     features_dict: {feature_id: {'mz': float, 'rt': float, 'intensity': float, 'file': str}}
-    ms2_spectra_dict: {feature_id: [(mz, intensity), ...]}
+    ms2_spectra_dict: {feature_id: (mz_array, intensity_array)}, sorted by m/z
+    (float32 when the file stores 32-bit arrays, float64 otherwise)
     """
     print(f"Processing {mzml_path.name}...")
     
     features = {}
     ms2_spectra = {}
+    ok = True
     
     try:
         run = pymzml.run.Reader(str(mzml_path))
@@ -125,6 +326,10 @@ def extract_features_from_mzml(mzml_path, is_blank=False):
         ms2_count = 0
         total_ms2_spectra = 0  # Debug counter
         
+        # Non-blank features sorted by m/z, for matching MS2 precursors
+        sorted_mzs = []
+        sorted_entries = []
+        
         for spectrum in run:
             ms_level = spectrum.get('ms level', 0)
             rt = spectrum.get('scan time', None)  # in minutes
@@ -137,9 +342,10 @@ def extract_features_from_mzml(mzml_path, is_blank=False):
                 # MS1 spectrum - extract features (peaks)
                 peaks = spectrum.peaks('raw')
                 if peaks is not None and len(peaks) > 0:
-                    # Find base peak (highest intensity)
-                    base_peak = max(peaks, key=lambda x: x[1] if len(x) > 1 else 0)
-                    if len(base_peak) >= 2 and base_peak[1] > 0:
+                    # Find base peak (highest intensity; first one on ties)
+                    peaks = np.asarray(peaks)
+                    base_peak = peaks[peaks[:, 1].argmax()]
+                    if base_peak[1] > 0:
                         feature_id = f"feature_{mzml_path.stem}_{feature_counter:04d}"
                         feature_counter += 1
                         
@@ -150,9 +356,15 @@ def extract_features_from_mzml(mzml_path, is_blank=False):
                             'file': mzml_path.stem,
                             'is_blank': is_blank
                         }
+                        if not is_blank:
+                            add_sorted_feature(sorted_mzs, sorted_entries, float(base_peak[0]), feature_id)
             
             elif ms_level == 2:
                 total_ms2_spectra += 1  # Debug: count all MS2 spectra
+                # Blank features are never offered for precursor matching and blank
+                # MS2 spectra never create features, so their peaks are not decoded
+                if is_blank:
+                    continue
                 # MS2 spectrum - extract precursor m/z
                 # In pymzml, precursor info is typically in selected_precursors
                 precursor_mz = None
@@ -205,26 +417,28 @@ def extract_features_from_mzml(mzml_path, is_blank=False):
                 if peaks is None or len(peaks) == 0:
                     continue
                 
+                # Keep the precision the file was written in: 32-bit arrays stay
+                # float32 (half the memory), anything else is stored as float64
+                peaks = np.asarray(peaks)
+                if peaks.dtype != np.float32:
+                    peaks = peaks.astype(np.float64)
+                
                 # Filter low intensity peaks (top 50 or intensity > 1% of max)
-                max_intensity = max(p[1] for p in peaks if len(p) > 1)
+                max_intensity = float(peaks[:, 1].max())
                 threshold = max(0.01 * max_intensity, max_intensity / 50.0)
-                filtered_peaks = [(float(p[0]), float(p[1])) for p in peaks 
-                                if len(p) > 1 and p[1] >= threshold]
+                peaks = peaks[peaks[:, 1] >= np.float64(threshold)]
                 
-                if not filtered_peaks:
+                if len(peaks) == 0:
                     continue
                 
+                # Store as separate m/z and intensity arrays, sorted by m/z
+                peaks = peaks[np.argsort(peaks[:, 0], kind='stable')]
+                filtered_peaks = (np.ascontiguousarray(peaks[:, 0]),
+                                  np.ascontiguousarray(peaks[:, 1]))
+                
                 # Find closest feature by precursor m/z (within tolerance)
-                best_feature = None
-                min_diff = float('inf')
                 mz_tolerance = 0.1  # 0.1 Da tolerance
-                
-                for fid, feat in features.items():
-                    if not feat.get('is_blank', False):
-                        diff = abs(feat['mz'] - precursor_mz)
-                        if diff < min_diff and diff < mz_tolerance:
-                            min_diff = diff
-                            best_feature = fid
+                best_feature = closest_feature(sorted_mzs, sorted_entries, precursor_mz, mz_tolerance)
                 
                 if best_feature:
                     # Add MS2 to existing feature
@@ -236,172 +450,362 @@ def extract_features_from_mzml(mzml_path, is_blank=False):
                     features[feature_id] = {
                         'mz': float(precursor_mz),
                         'rt': rt if rt else 0.0,
-                        'intensity': sum(p[1] for p in filtered_peaks),
+                        'intensity': float(filtered_peaks[1].sum(dtype=np.float64)),
                         'file': mzml_path.stem,
                         'is_blank': is_blank
                     }
                     ms2_spectra[feature_id] = filtered_peaks
+                    add_sorted_feature(sorted_mzs, sorted_entries, float(precursor_mz), feature_id)
                     ms2_count += 1
         
-        print(f"  Extracted {len(features)} features, {ms2_count} with MS2 spectra (found {total_ms2_spectra} total MS2 spectra in file)")
+        # Count features that ended up with a spectrum (the cache loader reports the same);
+        # ms2_count also counts spectra that replaced an earlier one for the same feature
+        print(f"  Extracted {len(features)} features, {len(ms2_spectra)} with MS2 spectra (found {total_ms2_spectra} total MS2 spectra in file)")
         
     except Exception as e:
+        ok = False
         print(f"  Error processing {mzml_path}: {e}")
         import traceback
         traceback.print_exc()
     
+    return features, ms2_spectra, ok
+
+
+def feature_cache_path(cache_dir, mzml_path, is_blank):
+    """
+    Cache file for the features of one mzML file, keyed by the file's path,
+    modification time and size (any change to the file gives a new key). The
+    stem is part of the key too: feature IDs embed it, so a symlink under
+    another name must not reuse IDs cached for the original name.
+    """
+    stat = mzml_path.stat()
+    key = (f"{FEATURE_CACHE_VERSION}|{mzml_path.resolve()}|{mzml_path.stem}|"
+           f"{stat.st_mtime_ns}|{stat.st_size}|{is_blank}")
+    return cache_dir / f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.npz"
+
+
+def save_feature_cache(cache_path, features, ms2_spectra):
+    """
+    Store extract_features_from_mzml output as flat arrays in a compressed .npz
+    (MS2 spectra packed end to end, in their original precision).
+    """
+    feats = features.values()
+    spectra = list(ms2_spectra.values())
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(mzs) for mzs, _ in spectra])
+    if spectra:
+        ms2_mz = np.concatenate([mzs for mzs, _ in spectra])
+        ms2_int = np.concatenate([intensities for _, intensities in spectra])
+    else:
+        ms2_mz = ms2_int = np.empty(0)
+    
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name and renamed, so a cache file is never half-written
+    tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            ids=np.array(list(features), dtype=str),
+            mz=np.array([feat['mz'] for feat in feats], dtype=np.float64),
+            rt=np.array([feat['rt'] for feat in feats], dtype=np.float64),
+            intensity=np.array([feat['intensity'] for feat in feats], dtype=np.float64),
+            ms2_ids=np.array(list(ms2_spectra), dtype=str),
+            ms2_mz=ms2_mz,
+            ms2_int=ms2_int,
+            ms2_offsets=offsets,
+        )
+    os.replace(tmp_path, cache_path)
+
+
+def load_feature_cache(cache_path, mzml_path, is_blank):
+    """
+    Rebuild (features_dict, ms2_spectra_dict) from a save_feature_cache file.
+    Returns None when there is no usable cache file.
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            data = dict(data)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+    
+    features = {
+        fid: {'mz': mz, 'rt': rt, 'intensity': intensity, 'file': mzml_path.stem, 'is_blank': is_blank}
+        for fid, mz, rt, intensity in zip(data['ids'].tolist(), data['mz'].tolist(),
+                                          data['rt'].tolist(), data['intensity'].tolist())
+    }
+    offsets = data['ms2_offsets']
+    ms2_spectra = {
+        fid: (data['ms2_mz'][offsets[k]:offsets[k + 1]], data['ms2_int'][offsets[k]:offsets[k + 1]])
+        for k, fid in enumerate(data['ms2_ids'].tolist())
+    }
     return features, ms2_spectra
 
 
-def blank_subtraction(sample_features, blank_features, intensity_ratio_threshold=3.0):
+def load_or_extract_features(mzml_path, is_blank, cache_dir):
     """
-    Remove features that appear in blank (with similar intensity).
-    Returns filtered features dict.
+    extract_features_from_mzml for one file, reusing the cached result when
+    cache_dir is set and has one (and caching a fresh, complete result there).
+    Returns (features_dict, ms2_spectra_dict).
     """
-    print(f"Blank subtraction: {len(sample_features)} sample features, {len(blank_features)} blank features")
+    if cache_dir is None:
+        features, ms2_spectra, _ = extract_features_from_mzml(mzml_path, is_blank=is_blank)
+        return features, ms2_spectra
     
-    filtered = {}
-    removed = 0
+    cache_path = feature_cache_path(cache_dir, mzml_path, is_blank)
+    cached = load_feature_cache(cache_path, mzml_path, is_blank)
+    if cached is not None:
+        print(f"Loaded {mzml_path.name} from cache ({len(cached[0])} features, {len(cached[1])} with MS2 spectra)")
+        return cached
     
-    for fid, feat in sample_features.items():
-        mz = feat['mz']
-        rt = feat['rt']
-        intensity = feat['intensity']
-        
-        # Check if similar feature exists in blank
-        found_in_blank = False
-        for blank_fid, blank_feat in blank_features.items():
-            mz_diff = abs(blank_feat['mz'] - mz)
-            rt_diff = abs(blank_feat['rt'] - rt) if rt and blank_feat['rt'] else 0
-            
-            # Within 0.01 Da and 0.1 min
-            if mz_diff < 0.01 and rt_diff < 0.1:
-                # Check intensity ratio
-                if blank_feat['intensity'] > 0:
-                    ratio = intensity / blank_feat['intensity']
-                    if ratio < intensity_ratio_threshold:
-                        found_in_blank = True
-                        removed += 1
-                        break
-        
-        if not found_in_blank:
-            filtered[fid] = feat
+    features, ms2_spectra, ok = extract_features_from_mzml(mzml_path, is_blank=is_blank)
+    # Only a complete parse is cached, so a failed read is retried next run
+    if ok:
+        try:
+            save_feature_cache(cache_path, features, ms2_spectra)
+        except OSError as e:
+            print(f"  Warning: could not write feature cache {cache_path}: {e}")
+    return features, ms2_spectra
+
+
+def extract_features_job(job):
+    """
+    Worker entry point: load_or_extract_features for one (mzml_path, is_blank,
+    cache_dir) job. Everything the job prints (including pymzml's own messages
+    and tracebacks) is captured and returned with the result, so the parent can
+    print each file's output in one piece and in file order.
+    Returns (features_dict, ms2_spectra_dict, stdout_text, stderr_text).
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        features, ms2_spectra = load_or_extract_features(*job)
+    return features, ms2_spectra, stdout.getvalue(), stderr.getvalue()
+
+
+def report_job(result):
+    """Print the output captured by extract_features_job and return (features_dict, ms2_spectra_dict)."""
+    features, ms2_spectra, stdout_text, stderr_text = result
+    sys.stdout.write(stdout_text)
+    sys.stderr.write(stderr_text)
+    return features, ms2_spectra
+
+
+def feature_columns(features):
+    """
+    Columns of a features dict as parallel float64 arrays, in dict order.
+    Returns (mz, rt, intensity); missing RTs are stored as 0.
+    """
+    n = len(features)
+    feats = features.values()
+    mz = np.fromiter((feat['mz'] for feat in feats), dtype=np.float64, count=n)
+    rt = np.fromiter((feat['rt'] or 0.0 for feat in feats), dtype=np.float64, count=n)
+    intensity = np.fromiter((feat['intensity'] for feat in feats), dtype=np.float64, count=n)
+    return mz, rt, intensity
+
+
+def prefetch_file(path):
+    """
+    Ask the OS to start reading a file into the page cache in the background,
+    so parsing it later does not wait on the disk. Does nothing where unsupported.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def prefetched(results, paths, ahead):
+    """
+    Pass results through in order, keeping the files up to `ahead` jobs past the
+    last finished one prefetched (the read-ahead never runs further than that).
+    """
+    for path in paths[:ahead]:
+        prefetch_file(path)
+    for k, result in enumerate(results):
+        if k + ahead < len(paths):
+            prefetch_file(paths[k + ahead])
+        yield result
+
+
+def build_blank_index(blank_features):
+    """
+    Sort blank features by m/z once, for repeated blank_feature_mask lookups.
+    Returns (blank_mz, blank_rt, blank_int) arrays; missing RTs are stored as 0.
+    """
+    blank_mz, blank_rt, blank_int = feature_columns(blank_features)
+    order = np.argsort(blank_mz)
+    return blank_mz[order], blank_rt[order], blank_int[order]
+
+
+def blank_feature_mask(sample_features, blank_index, intensity_ratio_threshold=3.0):
+    """
+    Return a boolean array (in sample_features order) that is True for features
+    found in the blank with similar intensity.
+    """
+    blank_mz, blank_rt, blank_int = blank_index
+    n = len(sample_features)
+    found_in_blank = np.zeros(n, dtype=bool)
+    if n == 0 or len(blank_mz) == 0:
+        return found_in_blank
     
-    print(f"  Removed {removed} blank features, {len(filtered)} remaining")
-    return filtered
+    sample_mz, sample_rt, sample_int = feature_columns(sample_features)
+    
+    # Binary search for the blank features within +/- BLANK_MZ_TOLERANCE of each
+    # sample; the window is inclusive and the strict test is applied below
+    lo = np.searchsorted(blank_mz, sample_mz - BLANK_MZ_TOLERANCE, side='left')
+    hi = np.searchsorted(blank_mz, sample_mz + BLANK_MZ_TOLERANCE, side='right')
+    counts = hi - lo
+    
+    # Expand to flat (sample, blank) candidate pairs
+    sample_idx = np.repeat(np.arange(n), counts)
+    blank_idx = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                 + np.repeat(lo, counts))
+    
+    # Within 0.01 Da and 0.1 min (RT is ignored when either side has none)
+    pair_mz_diff = np.abs(blank_mz[blank_idx] - sample_mz[sample_idx])
+    pair_blank_rt = blank_rt[blank_idx]
+    pair_sample_rt = sample_rt[sample_idx]
+    pair_rt_diff = np.where((pair_sample_rt != 0) & (pair_blank_rt != 0),
+                            np.abs(pair_blank_rt - pair_sample_rt), 0.0)
+    
+    # Check intensity ratio
+    pair_blank_int = blank_int[blank_idx]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = sample_int[sample_idx] / pair_blank_int
+    hit = ((pair_mz_diff < BLANK_MZ_TOLERANCE) & (pair_rt_diff < BLANK_RT_TOLERANCE)
+           & (pair_blank_int > 0) & (ratio < intensity_ratio_threshold))
+    found_in_blank[sample_idx[hit]] = True
+    return found_in_blank
 
 
-def create_network(features, ms2_spectra, num_nodes=50, similarity_threshold=0.7, max_mz=500.0):
+def create_network(features, ms2_spectra, num_nodes=50, similarity_threshold=0.7, max_mz=500.0,
+                   similarity_method='merge', bin_width=MS2_MZ_TOLERANCE):
     """
     Create a molecular network based on MS2 cosine similarity.
     Selects nodes with small m/z values, including both connected nodes and singletons.
-    Returns: NetworkX graph with selected nodes (mix of connected and singleton).
+    similarity_method is 'merge' (exact peak matching) or 'binned' (one matrix product
+    over spectra binned at bin_width).
+    Returns: (NetworkX graph with selected nodes (mix of connected and singleton),
+             features dict for those nodes).
     """
     print(f"\nCreating network from {len(features)} features...")
     
-    # Filter to features with MS2 data and small m/z
-    features_with_ms2_all = {fid: feat for fid, feat in features.items() if fid in ms2_spectra}
+    # Filter to features with MS2 data and small m/z, on an m/z column built once
+    fids_all = [fid for fid in features if fid in ms2_spectra]
+    mz_all = np.fromiter((features[fid]['mz'] for fid in fids_all), dtype=np.float64,
+                         count=len(fids_all))
     
     # Show m/z statistics
-    if features_with_ms2_all:
-        mz_values = [feat.get('mz', 0) for feat in features_with_ms2_all.values()]
-        mz_values.sort()
-        print(f"  {len(features_with_ms2_all)} features have MS2 spectra")
+    if fids_all:
+        mz_values = np.sort(mz_all)
+        print(f"  {len(fids_all)} features have MS2 spectra")
         print(f"  m/z range: {mz_values[0]:.2f} - {mz_values[-1]:.2f} (median: {mz_values[len(mz_values)//2]:.2f})")
     else:
         print(f"  WARNING: No features have MS2 spectra after blank subtraction!")
         return nx.Graph(), {}
     
     # Filter by max_mz
-    features_with_ms2 = {fid: feat for fid, feat in features_with_ms2_all.items() 
-                        if feat.get('mz', float('inf')) <= max_mz}
-    print(f"  {len(features_with_ms2)} features have MS2 spectra and m/z <= {max_mz}")
+    keep = mz_all <= max_mz
+    fids = [fid for fid, kept in zip(fids_all, keep.tolist()) if kept]
+    mz_arr = mz_all[keep]
+    print(f"  {len(fids)} features have MS2 spectra and m/z <= {max_mz}")
     
-    if len(features_with_ms2) == 0:
+    if len(fids) == 0:
         print(f"  ERROR: No features meet m/z <= {max_mz} criterion!")
         print(f"  Try increasing --max-mz (current: {max_mz})")
         print(f"  Suggested: --max-mz {min(2000.0, max(500.0, mz_values[-1] * 1.1)):.0f}")
         return nx.Graph(), {}
     
-    if len(features_with_ms2) < num_nodes:
-        print(f"  Note: Only {len(features_with_ms2)} features meet m/z <= {max_mz} criterion")
-        if len(features_with_ms2) == 0:
+    if len(fids) < num_nodes:
+        print(f"  Note: Only {len(fids)} features meet m/z <= {max_mz} criterion")
+        if len(fids) == 0:
             print(f"  ERROR: No features meet m/z <= {max_mz} criterion!")
             print(f"  Try increasing --max-mz (current: {max_mz})")
-            if mz_values:
+            if len(mz_values):
                 suggested_max = min(2000.0, max(500.0, mz_values[-1] * 1.1))
                 print(f"  Suggested: --max-mz {suggested_max:.0f}")
             return nx.Graph(), {}
-        num_nodes = len(features_with_ms2)
+        num_nodes = len(fids)
         print(f"  Using all {num_nodes} features that meet criteria")
     
-    # Sort features by m/z (smallest first)
-    sorted_features = sorted(features_with_ms2.items(), key=lambda x: x[1].get('mz', 0))
-    feature_list = [fid for fid, _ in sorted_features[:num_nodes*2]]  # Get more candidates
+    # Take the num_nodes*2 smallest m/z features as candidates (smallest first).
+    # A partition finds them without sorting every feature; ties keep input order.
+    k = min(num_nodes * 2, len(fids))
+    if k < len(fids):
+        kth_mz = np.partition(mz_arr, k - 1)[k - 1]
+        below = np.flatnonzero(mz_arr < kth_mz)
+        at_kth = np.flatnonzero(mz_arr == kth_mz)[:k - len(below)]
+        idx = np.concatenate([below, at_kth])
+    else:
+        idx = np.arange(len(fids))
+    idx = idx[np.lexsort((idx, mz_arr[idx]))]
+    feature_list = [fids[i] for i in idx]
     
     # Compute similarity matrix for candidates
     n = len(feature_list)
     print(f"  Computing MS2 cosine similarities for {n} candidate features...")
-    similarity_matrix = np.zeros((n, n))
     
-    for i in range(n):
-        if i % 10 == 0:
-            print(f"    Processing feature {i}/{n}...")
-        for j in range(i + 1, n):
-            fid1 = feature_list[i]
-            fid2 = feature_list[j]
-            sim = cosine_similarity_ms2(ms2_spectra[fid1], ms2_spectra[fid2])
-            similarity_matrix[i, j] = sim
-            similarity_matrix[j, i] = sim
+    # Pack the candidate spectra end to end so each spectrum is prepared once
+    # and every pair is scored in one call
+    mz_flat, int_flat, offsets = pack_spectra([ms2_spectra[fid] for fid in feature_list])
     
-    # Create network
-    G = nx.Graph()
+    # Keep only the pairs above threshold (upper triangle, row-major order) as
+    # sparse (row, col, score) triples
+    if similarity_method == 'binned':
+        similarity_matrix = binned_similarity_matrix(mz_flat, int_flat, offsets, bin_width)
+        edge_rows, edge_cols = np.nonzero(np.triu(similarity_matrix >= similarity_threshold, k=1))
+        edge_scores = similarity_matrix[edge_rows, edge_cols]
+    else:
+        edge_rows, edge_cols, edge_scores = _similarity_edges(mz_flat, int_flat, offsets,
+                                                              MS2_MZ_TOLERANCE, similarity_threshold)
+    edge_count = len(edge_scores)
     
-    # Add edges above threshold
-    edge_count = 0
-    for i in range(n):
-        for j in range(i + 1, n):
-            if similarity_matrix[i, j] >= similarity_threshold:
-                G.add_edge(feature_list[i], feature_list[j], 
-                          weight=similarity_matrix[i, j],
-                          cosine=similarity_matrix[i, j])
-                edge_count += 1
+    # Degrees, and the order in which nodes first appear in the edge list, come
+    # straight from the edge arrays; only the selected subgraph is built in networkx
+    degree = np.bincount(np.concatenate((edge_rows, edge_cols)), minlength=n)
+    endpoints = np.column_stack((edge_rows, edge_cols)).ravel()
+    connected = endpoints[np.sort(np.unique(endpoints, return_index=True)[1])]
     
-    print(f"  Created network with {G.number_of_nodes()} nodes, {edge_count} edges")
+    print(f"  Created network with {len(connected)} nodes, {edge_count} edges")
     
     # Select nodes: mix of connected nodes and singletons
     # Strategy: Take top connected nodes (clusters) + some singletons (isolated nodes)
-    connected_nodes = [node for node in G.nodes() if G.degree(node) > 0]
-    # Singletons are features not in network at all, or in network but with degree 0
-    network_node_set = set(G.nodes())
-    singleton_candidates = [fid for fid in feature_list 
-                           if fid not in network_node_set or G.degree(fid) == 0]
-    
-    # Sort connected nodes by degree (most connected first)
-    connected_nodes_sorted = sorted(connected_nodes, key=lambda x: G.degree(x), reverse=True)
+    # Connected nodes are ranked by degree (most connected first; ties keep the order
+    # they first appeared in), singletons are candidates without any edge
+    connected_sorted = connected[np.argsort(-degree[connected], kind='stable')]
+    singleton_candidates = np.flatnonzero(degree == 0)
     
     # Select mix: ~70% connected nodes, ~30% singletons
     num_connected = int(num_nodes * 0.7)
     num_singletons = num_nodes - num_connected
     
-    selected_connected = connected_nodes_sorted[:num_connected]
+    selected = np.zeros(n, dtype=bool)
+    selected[connected_sorted[:num_connected]] = True
     selected_singletons = singleton_candidates[:num_singletons]
     
-    # Add singletons to graph (as isolated nodes)
-    for fid in selected_singletons:
-        if fid not in G.nodes():
-            G.add_node(fid)
-    
-    # Create subgraph with selected nodes
-    selected_nodes = selected_connected + selected_singletons
-    if len(selected_nodes) > num_nodes:
-        # Trim if needed (prefer connected over singletons if over limit)
-        selected_nodes = selected_connected[:num_connected] + selected_singletons[:num_nodes-num_connected]
-    
-    G = G.subgraph(selected_nodes).copy()
+    # Build the network from the selected nodes (connected ones in first-appearance
+    # order, then singletons) and the edges between them, in scan order
+    selected[selected_singletons] = True
+    node_order = np.concatenate((connected[selected[connected]], selected_singletons))
+    keep = selected[edge_rows] & selected[edge_cols]
+    G = nx.Graph()
+    G.add_nodes_from(feature_list[k] for k in node_order.tolist())
+    G.add_edges_from(
+        (feature_list[i], feature_list[j], {'weight': score, 'cosine': score})
+        for i, j, score in zip(edge_rows[keep].tolist(), edge_cols[keep].tolist(),
+                               edge_scores[keep].tolist())
+    )
     
     # Count stats
-    connected_count = sum(1 for node in G.nodes() if G.degree(node) > 0)
+    connected_count = sum(1 for _, d in G.degree() if d > 0)
     singleton_count = G.number_of_nodes() - connected_count
     
     print(f"  Selected {G.number_of_nodes()} nodes (max m/z {max_mz}):")
@@ -409,7 +813,18 @@ def create_network(features, ms2_spectra, num_nodes=50, similarity_threshold=0.7
     print(f"    - {singleton_count} singleton nodes (isolated)")
     print(f"    - {G.number_of_edges()} edges")
     
-    return G, features_with_ms2
+    # Only the selected nodes' features are handed on to the exporters
+    return G, {fid: features[fid] for fid in G}
+
+
+def format_peak_values(values, sep=','):
+    """Format a 1-D array of floats with 6 decimals, joined by sep, in one % call."""
+    return sep.join(['%.6f'] * len(values)) % tuple(values.tolist())
+
+
+def format_peak_lines(mzs, intensities):
+    """Format peaks as 'mz intensity' lines (6 decimals, newline-terminated), in one % call."""
+    return ('%.6f %.6f\n' * len(mzs)) % tuple(np.column_stack((mzs, intensities)).ravel().tolist())
 
 
 def export_mgf(features, ms2_spectra, network, output_path):
@@ -418,39 +833,101 @@ def export_mgf(features, ms2_spectra, network, output_path):
     """
     print(f"\nExporting MGF file to {output_path}...")
     
+    # Entries are formatted in memory and the whole file goes out in one write
+    entries = []
+    for node_id in network.nodes():
+        if node_id in ms2_spectra:
+            feat = features[node_id]
+            spectrum = ms2_spectra[node_id]
+            
+            # MGF entry header
+            lines = ["BEGIN IONS", f"FEATURE_ID={node_id}", f"PEPMASS={feat['mz']}"]
+            if feat.get('rt'):
+                lines.append(f"RTINSECONDS={feat['rt'] * 60}")
+            header = "\n".join(lines) + "\n"
+            
+            # MS2 peaks
+            entries.append(header + format_peak_lines(*spectrum) + "END IONS\n\n")
+    
     with open(output_path, 'w') as f:
-        for node_id in network.nodes():
-            if node_id in ms2_spectra:
-                feat = features[node_id]
-                spectrum = ms2_spectra[node_id]
-                
-                # Write MGF entry
-                f.write("BEGIN IONS\n")
-                f.write(f"FEATURE_ID={node_id}\n")
-                f.write(f"PEPMASS={feat['mz']}\n")
-                if feat.get('rt'):
-                    f.write(f"RTINSECONDS={feat['rt'] * 60}\n")
-                
-                # Write MS2 peaks
-                for mz, intensity in spectrum:
-                    f.write(f"{mz:.6f} {intensity:.6f}\n")
-                
-                f.write("END IONS\n\n")
+        f.write(''.join(entries))
     
-    print(f"  Exported {len([n for n in network.nodes() if n in ms2_spectra])} spectra to MGF")
+    print(f"  Exported {len(entries)} spectra to MGF")
 
 
+# Single-pass translation table for escape_xml
+XML_ESCAPE_TABLE = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    "'": '&apos;',
+})
+
 def escape_xml(text):
     """Escape XML special characters."""
     if text is None:
         return ""
-    text = str(text)
-    text = text.replace('&', '&amp;')
-    text = text.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
-    text = text.replace('"', '&quot;')
-    text = text.replace("'", '&apos;')
-    return text
+    return str(text).translate(XML_ESCAPE_TABLE)
+
+# XGMML element templates, filled with one % operation per node/edge
+XGMML_NODE_TEMPLATE = (
+    '  <node id="%d" label="%s">\n'
+    '    <att name="name" type="string" value="%s"/>\n'
+    '    <att name="mz" type="real" value="%.6f"/>\n'
+    '    <att name="rt" type="real" value="%.6f"/>\n'
+    '    <att name="intensity" type="real" value="%.6f"/>\n'
+    '    <att name="file" type="string" value="%s"/>\n'
+)
+XGMML_MS2_TEMPLATE = (
+    '    <att name="ms2mzvalues" type="string" value="%s"/>\n'
+    '    <att name="ms2intensities" type="string" value="%s"/>\n'
+)
+XGMML_EDGE_TEMPLATE = (
+    '  <edge source="%d" target="%d">\n'
+    '    <att name="cosine" type="real" value="%.4f"/>\n'
+    '    <att name="weight" type="real" value="%.4f"/>\n'
+    '  </edge>\n'
+)
+
+def write_xgmml(f, network, features, ms2_spectra):
+    """
+    Write network as an XGMML document to the text stream f.
+    The document is assembled in memory from the templates above and written
+    with a single call.
+    """
+    # Create mapping from node_id to numeric ID for XGMML compatibility
+    node_id_to_num = {node_id: idx for idx, node_id in enumerate(network.nodes(), start=1)}
+    
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n',
+             '<graph label="MS2 Molecular Network" xmlns="http://www.cs.rpi.edu/XGMML" directed="0">\n']
+    
+    # Write nodes - use numeric IDs for XGMML compatibility
+    for node_id, node_num in node_id_to_num.items():
+        feat = features.get(node_id, {})
+        node_id_escaped = escape_xml(node_id)
+        parts.append(XGMML_NODE_TEMPLATE % (
+            node_num, node_id_escaped, node_id_escaped,
+            feat.get('mz', 0), feat.get('rt', 0), feat.get('intensity', 0),
+            escape_xml(feat.get('file', '')),
+        ))
+        
+        # Add MS2 data directly to node attributes (comma-separated strings;
+        # formatted numbers never need escaping)
+        if node_id in ms2_spectra:
+            mzs, intensities = ms2_spectra[node_id]
+            parts.append(XGMML_MS2_TEMPLATE % (format_peak_values(mzs), format_peak_values(intensities)))
+        
+        parts.append('  </node>\n')
+    
+    # Write edges - use numeric IDs for source/target
+    for u, v, data in network.edges(data=True):
+        parts.append(XGMML_EDGE_TEMPLATE % (node_id_to_num[u], node_id_to_num[v],
+                                            data.get('cosine', 0), data.get('weight', 0)))
+    
+    parts.append('</graph>\n')
+    f.write(''.join(parts))
+
 
 def export_cytoscape_network(network, features, ms2_spectra, output_path):
     """
@@ -459,51 +936,8 @@ def export_cytoscape_network(network, features, ms2_spectra, output_path):
     """
     print(f"\nExporting network to {output_path}...")
     
-    # Create mapping from node_id to numeric ID for XGMML compatibility
-    node_id_to_num = {}
-    num_to_node_id = {}
-    for idx, node_id in enumerate(network.nodes(), start=1):
-        node_id_to_num[node_id] = idx
-        num_to_node_id[idx] = node_id
-    
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
-        f.write('<graph label="MS2 Molecular Network" xmlns="http://www.cs.rpi.edu/XGMML" directed="0">\n')
-        
-        # Write nodes - use numeric IDs for XGMML compatibility
-        for node_id in network.nodes():
-            feat = features.get(node_id, {})
-            node_num = node_id_to_num[node_id]
-            node_id_escaped = escape_xml(node_id)
-            
-            f.write(f'  <node id="{node_num}" label="{node_id_escaped}">\n')
-            f.write(f'    <att name="name" type="string" value="{node_id_escaped}"/>\n')
-            f.write(f'    <att name="mz" type="real" value="{feat.get("mz", 0):.6f}"/>\n')
-            f.write(f'    <att name="rt" type="real" value="{feat.get("rt", 0):.6f}"/>\n')
-            f.write(f'    <att name="intensity" type="real" value="{feat.get("intensity", 0):.6f}"/>\n')
-            file_val = escape_xml(feat.get('file', ''))
-            f.write(f'    <att name="file" type="string" value="{file_val}"/>\n')
-            
-            # Add MS2 data directly to node attributes (comma-separated strings)
-            if node_id in ms2_spectra:
-                spectrum = ms2_spectra[node_id]
-                mz_values = ','.join([f"{mz:.6f}" for mz, _ in spectrum])
-                intensity_values = ','.join([f"{intensity:.6f}" for _, intensity in spectrum])
-                f.write(f'    <att name="ms2mzvalues" type="string" value="{escape_xml(mz_values)}"/>\n')
-                f.write(f'    <att name="ms2intensities" type="string" value="{escape_xml(intensity_values)}"/>\n')
-            
-            f.write('  </node>\n')
-        
-        # Write edges - use numeric IDs for source/target
-        for u, v, data in network.edges(data=True):
-            u_num = node_id_to_num[u]
-            v_num = node_id_to_num[v]
-            f.write(f'  <edge source="{u_num}" target="{v_num}">\n')
-            f.write(f'    <att name="cosine" type="real" value="{data.get("cosine", 0):.4f}"/>\n')
-            f.write(f'    <att name="weight" type="real" value="{data.get("weight", 0):.4f}"/>\n')
-            f.write('  </edge>\n')
-        
-        f.write('</graph>\n')
+    with open(output_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        write_xgmml(f, network, features, ms2_spectra)
     
     print(f"  Exported network with {network.number_of_nodes()} nodes, {network.number_of_edges()} edges")
 
@@ -516,134 +950,66 @@ def export_cytoscape_session(network, features, ms2_spectra, output_path):
     """
     print(f"\nExporting Cytoscape session to {output_path}...")
     
-    # Create a temporary directory structure
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-        
-        # Create cysession.xml root element
+    now = datetime.now()
+    
+    # Create ZIP file (.cys) - every member is written straight into the archive
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
         # Cytoscape session format uses CySession as root with namespace
-        session_xml = ET.Element('CySession')
-        session_xml.set('xmlns', 'http://www.cytoscape.org')
-        session_xml.set('appName', 'Cytoscape')
-        session_xml.set('version', '3.10.4')
-        
-        # Create networks element
-        networks_elem = ET.SubElement(session_xml, 'networks')
-        network_elem = ET.SubElement(networks_elem, 'network')
-        network_elem.set('name', 'MS2 Molecular Network')
-        network_elem.set('id', '1')
-        network_elem.set('file', 'networks/network1.xgmml')
-        
-        # Create network XGMML content
-        network_xml = ET.Element('graph')
-        network_xml.set('label', 'MS2 Molecular Network')
-        network_xml.set('xmlns', 'http://www.cs.rpi.edu/XGMML')
-        network_xml.set('directed', '0')
-        
-        # Create mapping from node_id to numeric ID for XGMML compatibility
-        node_id_to_num = {}
-        for idx, node_id in enumerate(network.nodes(), start=1):
-            node_id_to_num[node_id] = idx
+        # (Cytoscape expects this name)
+        zipf.writestr('cysession.xml', CYSESSION_XML)
         
-        # Add nodes with attributes
-        for node_id in network.nodes():
-            feat = features.get(node_id, {})
-            node_num = node_id_to_num[node_id]
-            node_elem = ET.SubElement(network_xml, 'node')
-            node_elem.set('id', str(node_num))
-            node_elem.set('label', str(node_id))
-            
-            # Add attributes
-            attrs = [
-                ('name', 'string', str(node_id)),
-                ('mz', 'real', f"{feat.get('mz', 0):.6f}"),
-                ('rt', 'real', f"{feat.get('rt', 0):.6f}"),
-                ('intensity', 'real', f"{feat.get('intensity', 0):.6f}"),
-                ('file', 'string', feat.get('file', '')),
-            ]
-            
-            # Add MS2 data if available
-            if node_id in ms2_spectra:
-                spectrum = ms2_spectra[node_id]
-                mz_values = ','.join([f"{mz:.6f}" for mz, _ in spectrum])
-                intensity_values = ','.join([f"{intensity:.6f}" for _, intensity in spectrum])
-                attrs.extend([
-                    ('ms2mzvalues', 'string', mz_values),
-                    ('ms2intensities', 'string', intensity_values),
-                ])
-            
-            for name, attr_type, value in attrs:
-                att_elem = ET.SubElement(node_elem, 'att')
-                att_elem.set('name', name)
-                att_elem.set('type', attr_type)
-                att_elem.set('value', str(value))
-        
-        # Add edges - use numeric IDs
-        for u, v, data in network.edges(data=True):
-            edge_elem = ET.SubElement(network_xml, 'edge')
-            edge_elem.set('source', str(node_id_to_num[u]))
-            edge_elem.set('target', str(node_id_to_num[v]))
-            # Note: XGMML edges are undirected by default, skip directed attribute
-            
-            # Add edge attributes
-            cosine = data.get('cosine', 0)
-            weight = data.get('weight', 0)
-            
-            for name, attr_type, value in [
-                ('cosine', 'real', f"{cosine:.4f}"),
-                ('weight', 'real', f"{weight:.4f}"),
-            ]:
-                att_elem = ET.SubElement(edge_elem, 'att')
-                att_elem.set('name', name)
-                att_elem.set('type', attr_type)
-                att_elem.set('value', str(value))
-        
-        # Write network XGMML to file
-        networks_dir = temp_path / 'networks'
-        networks_dir.mkdir()
-        network_file = networks_dir / 'network1.xgmml'
-        
-        # Format XML nicely
-        rough_string = ET.tostring(network_xml, encoding='unicode')
-        reparsed = minidom.parseString(rough_string)
-        pretty_xml = reparsed.toprettyxml(indent="  ")
-        
-        with open(network_file, 'w', encoding='utf-8') as f:
-            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n')
-            # Skip the XML declaration from minidom as we already wrote it
-            lines = pretty_xml.split('\n')
-            if lines[0].startswith('<?xml'):
-                f.write('\n'.join(lines[1:]))
-            else:
-                f.write(pretty_xml)
-        
-        # Write cysession.xml (Cytoscape expects this name)
-        session_file = temp_path / 'cysession.xml'
-        rough_string = ET.tostring(session_xml, encoding='unicode')
-        reparsed = minidom.parseString(rough_string)
-        pretty_xml = reparsed.toprettyxml(indent="  ")
-        
-        with open(session_file, 'w', encoding='utf-8') as f:
-            f.write(pretty_xml)
-        
-        # Create ZIP file (.cys)
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(session_file, 'cysession.xml')
-            zipf.write(network_file, 'networks/network1.xgmml')
+        # Network XGMML, streamed exactly like export_cytoscape_network
+        network_info = zipfile.ZipInfo('networks/network1.xgmml', date_time=now.timetuple()[:6])
+        network_info.compress_type = zipfile.ZIP_DEFLATED
+        with zipf.open(network_info, 'w') as member, \
+                io.TextIOWrapper(member, encoding='utf-8') as f:
+            write_xgmml(f, network, features, ms2_spectra)
         
         # Create a simple properties file (optional but often included)
-        props_file = temp_path / 'props.props'
-        with open(props_file, 'w') as f:
-            f.write(f"sessionTimestamp={int(datetime.now().timestamp() * 1000)}\n")
-        
-        # Add props file to ZIP
-        with zipfile.ZipFile(output_path, 'a', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(props_file, 'props.props')
+        zipf.writestr('props.props', f"sessionTimestamp={int(now.timestamp() * 1000)}\n")
     
-    print(f"  Exported .cys session with {network.number_of_nodes()} nodes, {network.number_of_edges()} edges")
-    print(f"  MS2 data included in node attributes (ms2mzvalues, ms2intensities)")
-    print(f"  Note: If the .cys file doesn't open, try importing the .xgmml file instead")
-    print(f"        and saving it as .cys from within Cytoscape for full compatibility.")
+    sys.stdout.write(
+        f"  Exported .cys session with {network.number_of_nodes()} nodes, {network.number_of_edges()} edges\n"
+        "  MS2 data included in node attributes (ms2mzvalues, ms2intensities)\n"
+        "  Note: If the .cys file doesn't open, try importing the .xgmml file instead\n"
+        "        and saving it as .cys from within Cytoscape for full compatibility.\n"
+    )
+
+
+CYS_SUCCESS_MESSAGE = """
+✓ Success! Created:
+  - MGF file: {mgf}
+  - Cytoscape session (.cys): {net}
+  - Network file (XGMML): {xgmml}
+
+To use in Cytoscape:
+  1. Try opening {net} in Cytoscape (File → Open → File)
+     If that doesn't work, import {xgmml} instead (File → Import → Network → File)
+     and save it as .cys from within Cytoscape for full compatibility.
+  2. The network already includes ms2mzvalues and ms2intensities columns!
+  3. Select nodes/edges to view MS2 spectra!
+"""
+
+XGMML_SUCCESS_MESSAGE = """
+✓ Success! Created:
+  - MGF file: {mgf}
+  - Network file (XGMML): {net}
+
+To use in Cytoscape:
+  1. Open {net} in Cytoscape (File → Import → Network → File)
+  2. The network already includes ms2mzvalues and ms2intensities columns!
+  3. (Optional) Load {mgf} if you want to reload/update MS2 data
+  4. Select nodes/edges to view MS2 spectra!
+
+Tip: Use --output-network test_network.cys to create a .cys session file instead!
+"""
+
+# Network output by file extension: (exporter, exporter for the companion .xgmml
+# copy or None, closing message); any other extension is written as XGMML
+NETWORK_EXPORTERS = {
+    '.cys': (export_cytoscape_session, export_cytoscape_network, CYS_SUCCESS_MESSAGE),
+    '.xgmml': (export_cytoscape_network, None, XGMML_SUCCESS_MESSAGE),
+}
 
 
 def main():
@@ -671,8 +1037,16 @@ Output:
     parser.add_argument('--blank-file', help='Blank mzML file (auto-detected if contains "blank")')
     parser.add_argument('--similarity-threshold', type=float, default=0.7,
                        help='Minimum cosine similarity for edges (default: 0.7)')
+    parser.add_argument('--similarity-method', choices=['merge', 'binned'], default='merge',
+                       help='MS2 cosine method: exact peak merge, or faster approximate m/z binning (default: merge)')
+    parser.add_argument('--bin-width', type=float, default=MS2_MZ_TOLERANCE,
+                       help=f'm/z bin width for --similarity-method binned (default: {MS2_MZ_TOLERANCE})')
     parser.add_argument('--intensity-ratio', type=float, default=3.0,
                        help='Intensity ratio threshold for blank subtraction (default: 3.0)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                       help='Number of processes used to read mzML files (default: CPU count)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help=f'Always re-parse mzML files instead of reusing features cached in {FEATURE_CACHE_DIR}')
     
     args = parser.parse_args()
     
@@ -681,6 +1055,22 @@ Output:
         print(f"Warning: num-nodes should be 10-100, got {args.num_nodes}. Adjusting...")
         args.num_nodes = max(10, min(100, args.num_nodes))
     
+    if args.bin_width <= 0:
+        print(f"Error: --bin-width must be positive, got {args.bin_width}")
+        sys.exit(1)
+    
+    # Resolve the outputs up front: paths, exporters by extension (.cys or XGMML)
+    # and the closing message, so a bad output location fails before any parsing
+    output_mgf = Path(args.output_mgf)
+    output_network = Path(args.output_network)
+    export_primary, export_xgmml_copy, success_message = NETWORK_EXPORTERS.get(
+        output_network.suffix.lower(), NETWORK_EXPORTERS['.xgmml'])
+    xgmml_output = output_network.with_suffix('.xgmml') if export_xgmml_copy else None
+    for output_path in (output_mgf, output_network):
+        if not output_path.parent.is_dir():
+            print(f"Error: Output directory {output_path.parent} does not exist")
+            sys.exit(1)
+    
     input_dir = Path(args.input_dir)
     if not input_dir.exists():
         print(f"Error: Directory {input_dir} does not exist")
@@ -718,33 +1108,59 @@ Output:
     
     print(f"Processing {len(sample_files)} sample files\n")
     
-    # Step 1: Extract features from blank
+    # Steps 1-2: Extract features from blank and samples. Files are independent,
+    # so they are parsed in parallel; imap hands results back in file order as
+    # soon as each one is ready, so merging overlaps the remaining parsing
+    cache_dir = None if args.no_cache else FEATURE_CACHE_DIR
+    jobs = [(blank_file, True, cache_dir)] if blank_file else []
+    jobs += [(mzml_file, False, cache_dir) for mzml_file in sample_files]
+    workers = max(1, min(args.workers, len(jobs)))
+    
     blank_features = {}
     blank_ms2 = {}
-    if blank_file:
-        blank_features, blank_ms2 = extract_features_from_mzml(blank_file, is_blank=True)
-    
-    # Step 2: Extract features from samples
     all_features = {}
     all_ms2 = {}
+    sample_count = 0
+    with (mp.Pool(workers) if workers > 1 else nullcontext()) as pool:
+        results = pool.imap(extract_features_job, jobs) if pool else map(extract_features_job, jobs)
+        # Disk reads for the next file per worker overlap the parsing of the current ones
+        results = prefetched(results, [job[0] for job in jobs], workers + 1)
+        # Each file's messages are printed here, as its result is taken in order
+        results = map(report_job, results)
+        # Compile the similarity kernels while the workers parse, so the JIT cost
+        # is not paid after all the spectra are in
+        if pool:
+            warm_up_similarity_kernels()
+        if blank_file:
+            blank_features, blank_ms2 = next(results)
+        blank_index = build_blank_index(blank_features) if blank_features else None
+        
+        # Step 3: Blank subtraction, applied to each file as it arrives so features
+        # found in the blank (and their MS2 spectra) are never merged
+        for features, ms2 in results:
+            sample_count += len(features)
+            if blank_index is not None:
+                # Delete only the (usually few) blank hits from this file's dicts,
+                # then merge what is left in bulk
+                found_in_blank = blank_feature_mask(features, blank_index, args.intensity_ratio)
+                for fid in compress(list(features), found_in_blank):
+                    del features[fid]
+                    ms2.pop(fid, None)
+            all_features.update(features)
+            all_ms2.update(ms2)
     
-    for mzml_file in sample_files:
-        features, ms2 = extract_features_from_mzml(mzml_file, is_blank=False)
-        all_features.update(features)
-        all_ms2.update(ms2)
-    
-    # Step 3: Blank subtraction
-    if blank_file and blank_features:
-        all_features = blank_subtraction(all_features, blank_features, args.intensity_ratio)
-        # Also remove MS2 for removed features
-        all_ms2 = {fid: spec for fid, spec in all_ms2.items() if fid in all_features}
+    if blank_index is not None:
+        print(f"Blank subtraction: {sample_count} sample features, {len(blank_features)} blank features")
+        print(f"  Removed {sample_count - len(all_features)} blank features, {len(all_features)} remaining")
     
     # Step 4: Create network
     network, network_features = create_network(
         all_features, all_ms2, 
         num_nodes=args.num_nodes,
         similarity_threshold=args.similarity_threshold,
-        max_mz=args.max_mz
+        max_mz=args.max_mz,
+        similarity_method=args.similarity_method,
+        bin_width=args.bin_width
     )
     
     if network.number_of_nodes() == 0:
@@ -752,43 +1168,13 @@ Output:
         sys.exit(1)
     
     # Step 5: Export MGF file
-    output_mgf = Path(args.output_mgf)
     export_mgf(network_features, all_ms2, network, output_mgf)
     
-    # Step 6: Export network file
-    output_network = Path(args.output_network)
-    
-    # Determine if we should create .cys file (auto-detect from extension)
-    output_is_cys = output_network.suffix.lower() == '.cys'
-    
-    if output_is_cys:
-        # Export as .cys session file (includes MS2 data)
-        export_cytoscape_session(network, network_features, all_ms2, output_network)
-        # Also create XGMML version
-        xgmml_output = output_network.with_suffix('.xgmml')
-        export_cytoscape_network(network, network_features, all_ms2, xgmml_output)
-        print(f"\n✓ Success! Created:")
-        print(f"  - MGF file: {output_mgf}")
-        print(f"  - Cytoscape session (.cys): {output_network}")
-        print(f"  - Network file (XGMML): {xgmml_output}")
-        print(f"\nTo use in Cytoscape:")
-        print(f"  1. Try opening {output_network} in Cytoscape (File → Open → File)")
-        print(f"     If that doesn't work, import {xgmml_output} instead (File → Import → Network → File)")
-        print(f"     and save it as .cys from within Cytoscape for full compatibility.")
-        print(f"  2. The network already includes ms2mzvalues and ms2intensities columns!")
-        print(f"  3. Select nodes/edges to view MS2 spectra!")
-    else:
-        # Export as XGMML (includes MS2 data)
-        export_cytoscape_network(network, network_features, all_ms2, output_network)
-        print(f"\n✓ Success! Created:")
-        print(f"  - MGF file: {output_mgf}")
-        print(f"  - Network file (XGMML): {output_network}")
-        print(f"\nTo use in Cytoscape:")
-        print(f"  1. Open {output_network} in Cytoscape (File → Import → Network → File)")
-        print(f"  2. The network already includes ms2mzvalues and ms2intensities columns!")
-        print(f"  3. (Optional) Load {output_mgf} if you want to reload/update MS2 data")
-        print(f"  4. Select nodes/edges to view MS2 spectra!")
-        print(f"\nTip: Use --output-network test_network.cys to create a .cys session file instead!")
+    # Step 6: Export network file (exporters were picked from the extension above)
+    export_primary(network, network_features, all_ms2, output_network)
+    if export_xgmml_copy:
+        export_xgmml_copy(network, network_features, all_ms2, xgmml_output)
+    sys.stdout.write(success_message.format(mgf=output_mgf, net=output_network, xgmml=xgmml_output))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,10 @@
+"""
+Location of the per-file caches kept by the pipeline scripts between runs.
+"""
+import os
+from pathlib import Path
+
+
+def msplot_cache_dir():
+    """Return the msplot cache directory: $XDG_CACHE_HOME/msplot, or ~/.cache/msplot."""
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'msplot'
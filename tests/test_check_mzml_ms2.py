@@ -0,0 +1,102 @@
+"""
+Regression tests for the MS2 index sidecar of check_mzml_ms2.py.
+Run from the repository root with: python -m unittest discover tests
+"""
+import base64
+import re
+import struct
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import check_mzml_ms2
+
+
+def binary_array(values, accession, name):
+    """One uncompressed 64-bit <binaryDataArray>."""
+    data = base64.b64encode(struct.pack(f'<{len(values)}d', *values)).decode()
+    return (f'<binaryDataArray encodedLength="{len(data)}">'
+            '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>'
+            '<cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>'
+            f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>'
+            f'<binary>{data}</binary></binaryDataArray>')
+
+
+def native_id(index):
+    """msconvert-style native id of the spectrum at this index."""
+    return f'controllerType=0 controllerNumber=1 scan={index + 1}'
+
+
+def spectrum_xml(index, ms_level, precursor_mz=None):
+    """A small spectrum; MS2 spectra point at the spectrum before them as precursor."""
+    precursor = ''
+    if precursor_mz is not None:
+        precursor = (f'<precursorList count="1"><precursor spectrumRef="{native_id(index - 1)}"><selectedIonList count="1"><selectedIon>'
+                     f'<cvParam cvRef="MS" accession="MS:1000744" name="selected ion m/z" value="{precursor_mz}"/>'
+                     '</selectedIon></selectedIonList></precursor></precursorList>')
+    return (f'<spectrum index="{index}" id="{native_id(index)}" defaultArrayLength="3">'
+            f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>'
+            f'{precursor}<binaryDataArrayList count="2">'
+            + binary_array([100.0, 200.0, 300.0], 'MS:1000514', 'm/z array')
+            + binary_array([10.0, 20.0, 30.0], 'MS:1000515', 'intensity array')
+            + '</binaryDataArrayList></spectrum>\n')
+
+
+def write_indexed_mzml(path, levels):
+    """Write an indexed mzML (with <indexList>, as msconvert does) holding spectra of the given MS levels."""
+    spectra = ''.join(spectrum_xml(i, level, 150.0 + i if level == 2 else None)
+                      for i, level in enumerate(levels))
+    body = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n'
+            '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+            '<cvList count="1"><cv id="MS" fullName="PSI-MS" version="4.1.0" URI="x"/></cvList>\n'
+            f'<run id="r"><spectrumList count="{len(levels)}">\n{spectra}'
+            '</spectrumList></run>\n</mzML>\n').encode()
+    offsets = [(m.group(1).decode(), m.start())
+               for m in re.finditer(rb'<spectrum [^>]*id="([^"]+)"', body)]
+    index = ('<indexList count="1">\n<index name="spectrum">\n'
+             + ''.join(f'<offset idRef="{spectrum_id}">{offset}</offset>\n' for spectrum_id, offset in offsets)
+             + '</index>\n</indexList>\n'
+             f'<indexListOffset>{len(body)}</indexListOffset>\n'
+             '<fileChecksum>0</fileChecksum>\n</indexedmzML>\n')
+    path.write_bytes(body + index.encode())
+
+
+class IndexedMzmlCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.mzml_path = self.tmp / 'indexed.mzML'
+        write_indexed_mzml(self.mzml_path, [1, 2, 2, 1, 2, 2])
+
+        cache_dir = check_mzml_ms2.INDEX_CACHE_DIR
+        check_mzml_ms2.INDEX_CACHE_DIR = self.tmp / 'cache'
+        self.addCleanup(setattr, check_mzml_ms2, 'INDEX_CACHE_DIR', cache_dir)
+
+    def test_full_scan_of_indexed_file_is_cached_and_reused(self):
+        first = check_mzml_ms2.check_ms2_in_file(self.mzml_path, full_scan=True)
+        self.assertIsNone(first['error'])
+        self.assertEqual((first['ms1_count'], first['ms2_count'], first['ms2_with_precursor']), (2, 4, 4))
+        self.assertTrue(check_mzml_ms2.index_cache_path(self.mzml_path).exists())
+
+        index = check_mzml_ms2.load_ms2_index(self.mzml_path)
+        self.assertEqual([key for key, _, _ in index['ms2']], [2, 3, 5, 6])
+
+        second = check_mzml_ms2.check_ms2_in_file(self.mzml_path, full_scan=True)
+        self.assertIsNone(second['error'])
+        self.assertEqual(second['ms2_precursor_examples'], first['ms2_precursor_examples'])
+        self.assertEqual((second['ms1_count'], second['ms2_count'], second['ms2_with_precursor']), (2, 4, 4))
+
+    def test_missing_offset_skips_the_sidecar(self):
+        run = check_mzml_ms2.pymzml.run.Reader(str(self.mzml_path), obo_version=check_mzml_ms2.OBO_VERSION)
+        check_mzml_ms2.save_ms2_index(self.mzml_path, run, 0, [('no such spectrum', 0, 0)])
+        self.assertFalse(check_mzml_ms2.index_cache_path(self.mzml_path).exists())
+        self.assertIsNone(check_mzml_ms2.load_ms2_index(self.mzml_path))
+
+
+if __name__ == '__main__':
+    unittest.main()